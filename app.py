@@ -9,6 +9,21 @@ import plotly.graph_objs as go
 from math import ceil
 from dash.exceptions import PreventUpdate
 import pathlib
+import hashlib
+import json
+import os
+import re
+import random
+import time
+import cProfile
+import hmac
+import uuid
+import threading
+import atexit
+from collections import Counter
+from functools import lru_cache
+import flask
+from plotly.utils import PlotlyJSONEncoder
 
 # Sets the relative path
 PATH = pathlib.Path(__file__).parent
@@ -19,6 +34,15 @@ df = pd.read_csv(DATA_PATH.joinpath("UN_demographic_data.csv"))
 df_pp = pd.read_csv(DATA_PATH.joinpath("UN_population_pyramid_data.csv"))
 region_df = pd.read_csv(DATA_PATH.joinpath("Continent Codes.csv"), encoding='latin1')
 
+# Fingerprints the data files, this file and the release so cached responses
+# change whenever the data or the code that draws the figures does
+version_hash = hashlib.sha1()
+for name in ["UN_demographic_data.csv", "UN_population_pyramid_data.csv", "Continent Codes.csv"]:
+    version_hash.update(DATA_PATH.joinpath(name).read_bytes())
+version_hash.update(pathlib.Path(__file__).read_bytes())
+version_hash.update(os.environ.get('RELEASE', '').encode('utf-8'))
+CACHE_VERSION = version_hash.hexdigest()[:12]
+
 # Defines functions to create traces and layouts
 cols = [col for col in region_df.columns]
 region_df = region_df.fillna("nan")
@@ -29,6 +53,9 @@ for i in cols:
 
 input_values=["{}-{}".format(i, i+5) for i in range(1950,2100, 5)]
 
+# The builders below are memoized, so what they return is shared between requests
+# and with the initial layout; treat their results as read-only
+@lru_cache(maxsize=512)
 def create_trace(x, y1, y2, area='World',startdate=1950, enddate=2100):
     trace1=[
             {
@@ -53,6 +80,7 @@ def create_trace(x, y1, y2, area='World',startdate=1950, enddate=2100):
         ]
     return trace1
 
+@lru_cache(maxsize=512)
 def create_layout(y1, y2, startdate=1950, enddate=2100):
     axis_font_style={'size':11, 'family':'Franklin Gothic Medium', 'color':'#999B9A'}
     hover_font_style={'size':11, 'family':'Franklin Gothic Medium', 'color':'rgb(255,255,255)'}
@@ -79,6 +107,7 @@ def create_layout(y1, y2, startdate=1950, enddate=2100):
         )
     return layout1
 
+@lru_cache(maxsize=512)
 def pyramid_trace(area='World', year="2015-2020"):
     df_pp_new=df_pp[(df_pp['Country or Area']==area) & (df_pp['Year(s)']==year)]
     trace=[
@@ -106,6 +135,7 @@ def pyramid_trace(area='World', year="2015-2020"):
         ]
     return trace
 
+@lru_cache(maxsize=512)
 def pyramid_layout(area='World', year="2015-2020"):
     df_pp_new=df_pp[(df_pp['Country or Area']==area) & (df_pp['Year(s)']==year)]
     axis_font_style={'size':11, 'family':'Franklin Gothic Medium', 'color':'#999B9A'}
@@ -158,6 +188,7 @@ def pyramid_layout(area='World', year="2015-2020"):
         )
     return layout    
 
+@lru_cache(maxsize=512)
 def create_table(area, year_value):
     test_df=df[(df['Country or Area']==area) & (df['Year(s)']==year_value)][['Total Population', 'Population Change (%)','Total Fertility Rate', 'Life Expectancy at Birth', 'Infant Mortality Rate', 'Net Migration Rate', 'Sex Ratio at Birth']].copy()
 
@@ -174,6 +205,7 @@ def create_table(area, year_value):
 
     return test_df
 
+@lru_cache(maxsize=512)
 def create_map(country_value=None):
     temp_df=df.groupby('Country or Area').head(1)
     columns = [i for i in temp_df.columns]
@@ -702,5 +734,242 @@ def update_map(country_value):
         'layout':new_layout_map
     }
 
+######################################################
+
+# HTTP caching for figure responses
+# Every callback is a pure function of its inputs and of the data, so a hash of
+# the callback id, its inputs and CACHE_VERSION identifies the response exactly.
+# Callbacks themselves are POSTs, which are never revalidated, so conditional
+# requests are only handled by the GET figure route below.
+FIGURE_MAX_AGE = 60*60*24*365
+
+def callback_etag(payload):
+    key = json.dumps({
+        'output': payload.get('output'),
+        'inputs': [(i.get('id'), i.get('property'), i.get('value')) for i in payload.get('inputs', [])],
+        'state': [(i.get('id'), i.get('property'), i.get('value')) for i in payload.get('state', [])],
+        'version': CACHE_VERSION
+    }, sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def is_callback_request():
+    return flask.request.method == 'POST' and flask.request.path.endswith('_dash-update-component')
+
+# GET-addressable figures, e.g. /figures/graph-1.json?area=Africa&start=1950&end=2020&v=<CACHE_VERSION>
+# The cache version is part of the URL, so a reverse proxy can keep these for a long time.
+# __wrapped__ skips the JSON encoding dash adds around each callback
+figure_callbacks = {
+    'graph-1': lambda args: update_figure1.__wrapped__(args['area'], [args['start'], args['end']]),
+    'graph-2': lambda args: update_figure2.__wrapped__(args['area'], [args['start'], args['end']]),
+    'graph-3': lambda args: update_figure3.__wrapped__(args['area'], args['year']),
+    'graph-4': lambda args: update_figure4.__wrapped__(args['area'], [args['start'], args['end']]),
+    'graph-5': lambda args: update_figure5.__wrapped__(args['area'], [args['start'], args['end']]),
+    'map': lambda args: update_map.__wrapped__(args['area'])
+}
+
+# The query arguments each figure reads; only these go into its ETag and redirects
+figure_args = {
+    'graph-1': ['area', 'start', 'end'],
+    'graph-2': ['area', 'start', 'end'],
+    'graph-3': ['area', 'year'],
+    'graph-4': ['area', 'start', 'end'],
+    'graph-5': ['area', 'start', 'end'],
+    'map': ['area']
+}
+figure_defaults = {'area':'World', 'start':1950, 'end':2100, 'year':'2015-2020'}
+
+@app.server.route('/figures/<figure_id>.json')
+def serve_figure(figure_id):
+    if figure_id not in figure_callbacks:
+        flask.abort(404)
+    args = {key: flask.request.args.get(key, figure_defaults[key]) for key in figure_args[figure_id]}
+    try:
+        for key in ['start', 'end']:
+            if key in args:
+                args[key] = int(args[key])
+    except ValueError:
+        flask.abort(400)
+    if flask.request.args.get('v', CACHE_VERSION) != CACHE_VERSION:
+        # Stale links point to the current version instead of caching old data forever
+        query = dict(args, v=CACHE_VERSION)
+        return flask.redirect(flask.url_for('serve_figure', figure_id=figure_id, **query))
+    etag = callback_etag({
+        'output': figure_id,
+        'inputs': [{'id':key, 'value':args[key]} for key in figure_args[figure_id]]
+    })
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        try:
+            figure = figure_callbacks[figure_id](args)
+        except (KeyError, ValueError):
+            flask.abort(400)
+        response = flask.Response(json.dumps(figure, cls=PlotlyJSONEncoder), mimetype='application/json')
+    response.set_etag(etag)
+    if 'v' in flask.request.args:
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(FIGURE_MAX_AGE)
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+######################################################
+
+# Opt-in profiling of callback requests
+# Set PROFILE_DIR to turn it on; PROFILE_SAMPLE_RATE (0 to 1) picks the share of
+# callbacks to profile, and any callback sent with an X-Profile header matching
+# PROFILE_TOKEN is profiled too. Without a PROFILE_TOKEN the header is ignored.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_HEADER = 'X-Profile'
+
+def has_profile_token():
+    token = flask.request.headers.get(PROFILE_HEADER)
+    if not PROFILE_TOKEN or token is None:
+        return False
+    # Headers are decoded as latin-1, and compare_digest only accepts ASCII strings
+    return hmac.compare_digest(token.encode('latin-1'), PROFILE_TOKEN.encode('latin-1'))
+
+@app.server.before_request
+def start_profile():
+    if PROFILE_DIR is None or not is_callback_request():
+        return None
+    if random.random() >= PROFILE_SAMPLE_RATE and not has_profile_token():
+        return None
+    flask.g.profile = cProfile.Profile()
+    flask.g.profile.enable()
+    return None
+
+@app.server.after_request
+def stop_profile(response):
+    profile = flask.g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.disable()
+    payload = flask.request.get_json(silent=True) or {}
+    callback_id = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(payload.get('output', 'unknown'))).strip('._')
+    callback_dir = pathlib.Path(PROFILE_DIR).joinpath(callback_id)
+    # Several callbacks can finish in the same millisecond, so the name also needs a random part
+    file_name = '{}-{}-{}.pstats'.format(int(time.time()*1000), os.getpid(), uuid.uuid4().hex)
+    try:
+        callback_dir.mkdir(parents=True, exist_ok=True)
+        profile.dump_stats(callback_dir.joinpath(file_name))
+    except OSError:
+        # A profile that cannot be written is dropped rather than failing the request
+        pass
+    return response
+
+######################################################
+
+# Prewarming from recorded access patterns
+# Callbacks record which (area, slider range, year) combinations they serve, the
+# most popular PREWARM_TOP_K are saved to PREWARM_FILE, and on the next start a
+# background thread computes them in popularity order to fill the caches above.
+PREWARM_FILE = pathlib.Path(os.environ.get('PREWARM_FILE', PATH.joinpath('prewarm.json')))
+PREWARM_TOP_K = int(os.environ.get('PREWARM_TOP_K', 50))
+PREWARM_SAVE_INTERVAL = 300
+
+# One interaction fires several callbacks with the same inputs, so each kind of
+# combination is only counted from one of them
+recorded_outputs = {'graph-1.figure':'range', 'graph-3.figure':'year', 'map.figure':'area'}
+
+# Only combinations the UI can produce are counted, so crafted requests cannot
+# grow access_counts without limit or push real entries out of the top K
+recorded_areas = set(df['Country or Area'].unique()) | set(continent_dict.keys())
+
+def is_slider_year(value):
+    return isinstance(value, int) and not isinstance(value, bool) and 1950 <= value <= 2100
+
+access_counts = Counter()
+access_lock = threading.Lock()
+
+def default_prewarm_keys():
+    keys = []
+    for area in ['World'] + list(continent_dict.keys()):
+        keys += [('area', area), ('range', area, 1950, 2100), ('year', area, '2015-2020')]
+    return keys
+
+def load_prewarm_counts():
+    try:
+        with open(PREWARM_FILE) as f:
+            return Counter({tuple(entry['key']): entry['count'] for entry in json.load(f)})
+    except (OSError, ValueError, KeyError, TypeError):
+        return Counter()
+
+def save_prewarm_counts():
+    with access_lock:
+        new_counts = access_counts.copy()
+        access_counts.clear()
+    if not new_counts:
+        return
+    # Other workers write the same file, so their counts are merged rather than replaced.
+    # There is no lock between workers, so the merge is best-effort: saves that overlap
+    # can lose each other's counts.
+    counts = load_prewarm_counts() + new_counts
+    entries = [{'key':list(key), 'count':count} for key, count in counts.most_common(PREWARM_TOP_K)]
+    tmp_file = PREWARM_FILE.with_name('{}.{}.tmp'.format(PREWARM_FILE.name, os.getpid()))
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, PREWARM_FILE)
+    except OSError:
+        pass
+
+@app.server.after_request
+def record_access(response):
+    if response.status_code != 200 or not is_callback_request():
+        return response
+    payload = flask.request.get_json(silent=True) or {}
+    key_type = recorded_outputs.get(payload.get('output'))
+    values = {i.get('id'): i.get('value') for i in payload.get('inputs', [])}
+    area = values.get('dropdown')
+    if key_type is None or not isinstance(area, str) or area not in recorded_areas:
+        return response
+    slider_value = values.get('slider')
+    year_value = values.get('year_input')
+    if key_type == 'range' and isinstance(slider_value, list) and len(slider_value) == 2 \
+            and all(is_slider_year(value) for value in slider_value):
+        key = ('range', area, slider_value[0], slider_value[1])
+    elif key_type == 'year' and year_value in input_values:
+        key = ('year', area, year_value)
+    elif key_type == 'area':
+        key = ('area', area)
+    else:
+        return response
+    with access_lock:
+        access_counts[key] += 1
+    return response
+
+def prewarm_key(key):
+    # __wrapped__ skips the JSON encoding dash adds around each callback
+    if key[0] == 'range':
+        for update in [update_figure1, update_figure2, update_figure4, update_figure5]:
+            update.__wrapped__(key[1], [key[2], key[3]])
+    elif key[0] == 'year':
+        update_figure3.__wrapped__(key[1], key[2])
+        update_table.__wrapped__(key[1], key[2])
+    elif key[0] == 'area':
+        update_map.__wrapped__(key[1])
+
+def prewarm():
+    counts = load_prewarm_counts()
+    keys = [key for key, count in counts.most_common()]
+    keys += [key for key in default_prewarm_keys() if key not in counts]
+    for key in keys:
+        try:
+            prewarm_key(key)
+        except Exception:
+            # A bad or outdated entry should not stop the rest from being computed
+            continue
+        # Gives request threads a chance at the GIL between entries
+        time.sleep(0)
+    # Counts are written from this thread so requests never wait on the file
+    while True:
+        time.sleep(PREWARM_SAVE_INTERVAL)
+        save_prewarm_counts()
+
+atexit.register(save_prewarm_counts)
+threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
 if __name__=='__main__':
     app.run_server()
\ No newline at end of file